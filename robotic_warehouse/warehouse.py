@@ -3,7 +3,6 @@ import logging
 from collections import defaultdict, OrderedDict
 import gym
 from gym import spaces
-from numpy.lib.utils import info
 
 from robotic_warehouse.utils import MultiAgentActionSpace, MultiAgentObservationSpace
 
@@ -12,7 +11,11 @@ import numpy as np
 
 from typing import List, Tuple, Optional, Dict
 
-import networkx as nx
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
 
 _AXIS_Z = 0
 _AXIS_Y = 1
@@ -24,20 +27,6 @@ _LAYER_AGENTS = 0
 _LAYER_SHELFS = 1
 
 
-class _VectorWriter:
-    def __init__(self, size: int):
-        self.vector = np.zeros(size, dtype=np.float32)
-        self.idx = 0
-
-    def write(self, data):
-        data_size = len(data)
-        self.vector[self.idx : self.idx + data_size] = data
-        self.idx += data_size
-
-    def skip(self, bits):
-        self.idx += bits
-
-
 class Action(Enum):
     NOOP = 0
     FORWARD = 1
@@ -53,6 +42,15 @@ class Direction(Enum):
     RIGHT = 3
 
 
+_ALL_DIRECTIONS = tuple(Direction)
+
+# movement and rotation tables indexed by Direction.value
+_DX = (0, 0, -1, 1)
+_DY = (-1, 1, 0, 0)
+_ROT_LEFT = (Direction.LEFT, Direction.RIGHT, Direction.DOWN, Direction.UP)
+_ROT_RIGHT = (Direction.RIGHT, Direction.LEFT, Direction.UP, Direction.DOWN)
+
+
 class RewardType(Enum):
     GLOBAL = 0
     INDIVIDUAL = 1
@@ -91,25 +89,17 @@ class Agent(Entity):
     def req_location(self, grid_size) -> Tuple[int, int]:
         if self.req_action != Action.FORWARD:
             return self.x, self.y
-        elif self.dir == Direction.UP:
-            return self.x, max(0, self.y - 1)
-        elif self.dir == Direction.DOWN:
-            return self.x, min(grid_size[0] - 1, self.y + 1)
-        elif self.dir == Direction.LEFT:
-            return max(0, self.x - 1), self.y
-        elif self.dir == Direction.RIGHT:
-            return min(grid_size[1] - 1, self.x + 1), self.y
-
-        raise ValueError(
-            f"Direction is {self.dir}. Should be one of {[v for v in Direction]}"
+        d = self.dir.value
+        return (
+            min(max(self.x + _DX[d], 0), grid_size[1] - 1),
+            min(max(self.y + _DY[d], 0), grid_size[0] - 1),
         )
 
     def req_direction(self) -> Direction:
-        wraplist = [Direction.UP, Direction.RIGHT, Direction.DOWN, Direction.LEFT]
         if self.req_action == Action.RIGHT:
-            return wraplist[(wraplist.index(self.dir) + 1) % len(wraplist)]
+            return _ROT_RIGHT[self.dir.value]
         elif self.req_action == Action.LEFT:
-            return wraplist[(wraplist.index(self.dir) - 1) % len(wraplist)]
+            return _ROT_LEFT[self.dir.value]
         else:
             return self.dir
 
@@ -126,6 +116,159 @@ class Shelf(Entity):
         return (_LAYER_SHELFS,)
 
 
+def _resolve_conflicts(next_idx, sink_key, n_cells):
+    """Decide which agents may execute their requested move.
+
+    Every agent requests exactly one target cell, so the movement graph is
+    a functional graph: each weakly connected component contains at most
+    one cycle, with trees of followers hanging off it. This resolves the
+    component structure in O(n) with flat arrays:
+
+    - a 2-cycle is a head-on collision; nobody in that component moves
+    - any other cycle (incl. self-loops) commits exactly its members
+    - an acyclic component commits the agents on its longest chain into
+      the free sink cell; competing branches stay put
+
+    ``next_idx[i]`` is the index of the agent standing on agent i's target
+    cell (or -1 if that cell is free) and ``sink_key[i]`` is the flattened
+    target cell index, used to tell apart chains ending in different free
+    cells. Returns a boolean committed mask.
+    """
+    n = len(next_idx)
+    committed = np.zeros(n, dtype=np.bool_)
+    # 0 = unseen, 1 = on current path, 2 = resolved
+    state = np.zeros(n, dtype=np.int8)
+    # for tree nodes: distance (in moves) to the free sink cell
+    dist = np.zeros(n, dtype=np.int64)
+    # the free sink cell of each tree node, or -2 for cycle components
+    root = np.full(n, -1, dtype=np.int64)
+    path = np.empty(n, dtype=np.int64)
+
+    for s in range(n):
+        if state[s] != 0:
+            continue
+        top = 0
+        i = s
+        while i != -1 and state[i] == 0:
+            state[i] = 1
+            path[top] = i
+            top += 1
+            i = next_idx[i]
+
+        if i == -1:
+            # walked off into a free cell: a fresh tree path
+            sink = sink_key[path[top - 1]]
+            for k in range(top):
+                j = path[k]
+                dist[j] = top - k
+                root[j] = sink
+                state[j] = 2
+        elif state[i] == 1:
+            # closed a new cycle; find where it starts on the path
+            k0 = top - 1
+            while path[k0] != i:
+                k0 -= 1
+            if top - k0 != 2:  # 2-cycles are head-on collisions
+                for k in range(k0, top):
+                    committed[path[k]] = True
+            for k in range(top):
+                root[path[k]] = -2
+                state[path[k]] = 2
+        else:
+            # joined an already resolved node
+            if root[i] == -2:
+                for k in range(top):
+                    root[path[k]] = -2
+                    state[path[k]] = 2
+            else:
+                sink = root[i]
+                base = dist[i]
+                for k in range(top):
+                    j = path[k]
+                    dist[j] = base + top - k
+                    root[j] = sink
+                    state[j] = 2
+
+    # per tree, commit only the deepest chain into the sink
+    best_dist = np.zeros(n_cells, dtype=np.int64)
+    best_node = np.full(n_cells, -1, dtype=np.int64)
+    for i in range(n):
+        if root[i] >= 0 and dist[i] > best_dist[root[i]]:
+            best_dist[root[i]] = dist[i]
+            best_node[root[i]] = i
+    for i in range(n):
+        if root[i] >= 0 and best_node[root[i]] == i:
+            j = i
+            while j != -1:
+                committed[j] = True
+                j = next_idx[j]
+
+    return committed
+
+
+def _fill_obs(
+    padded_agents,
+    padded_shelfs,
+    highway,
+    ay,
+    ax,
+    dirs,
+    msgs,
+    carry,
+    requested,
+    win_size,
+    n_self_bits,
+    out,
+):
+    """Fill the fast-obs buffer, one row per agent.
+
+    Writes the same bit layout as the vectorized path in _make_obs_all
+    (including the direction-0 one-hot on empty sensor cells) but without
+    any temporaries; with numba the agents are processed in parallel.
+    """
+    n_agents = ay.shape[0]
+    msg_bits = msgs.shape[1]
+    for i in prange(n_agents):
+        x = ax[i]
+        y = ay[i]
+        out[i, :] = 0.0
+        out[i, 0] = x
+        out[i, 1] = y
+        out[i, 2] = carry[i]
+        out[i, 3 + dirs[i]] = 1.0
+        if highway[y, x]:
+            out[i, 7] = 1.0
+
+        # in padded coordinates the window around (x, y) starts at (y, x)
+        idx = n_self_bits
+        for wy in range(win_size):
+            for wx in range(win_size):
+                aid = padded_agents[y + wy, x + wx]
+                if aid == 0:
+                    # empty cells keep the direction-0 one-hot
+                    out[i, idx + 1] = 1.0
+                else:
+                    out[i, idx] = 1.0
+                    out[i, idx + 1 + dirs[aid - 1]] = 1.0
+                    for b in range(msg_bits):
+                        out[i, idx + 5 + b] = msgs[aid - 1, b]
+                idx += 5 + msg_bits
+                sid = padded_shelfs[y + wy, x + wx]
+                if sid != 0:
+                    out[i, idx] = 1.0
+                    if requested[sid]:
+                        out[i, idx + 1] = 1.0
+                idx += 2
+
+
+if njit is not None:
+    # compiles the plain-arrays kernels as is; without numba the pure
+    # Python versions above are used unchanged (_make_obs_all keeps a
+    # vectorized fallback instead of the slow per-cell loop)
+    _resolve_conflicts = njit(cache=True)(_resolve_conflicts)
+    _fill_obs = njit(cache=True, parallel=True)(_fill_obs)
+
+
 class Warehouse(gym.Env):
 
     metadata = {"render.modes": ["human", "rgb_array"]}
@@ -208,6 +351,13 @@ class Warehouse(gym.Env):
         self.sensor_range = sensor_range
         self.max_inactivity_steps: Optional[int] = max_inactivity_steps
         self.reward_type = reward_type
+        # the reward type is fixed for the lifetime of the env, so resolve
+        # the dispatch once instead of re-branching on every reward event
+        self._apply_reward = {
+            RewardType.GLOBAL: self._apply_reward_global,
+            RewardType.INDIVIDUAL: self._apply_reward_individual,
+            RewardType.TWO_STAGE: self._apply_reward_two_stage,
+        }[reward_type]
         # self.reward_range = (0, 1)
         self.reward_range = (-float("inf"), float("inf"))
 
@@ -215,7 +365,36 @@ class Warehouse(gym.Env):
         self._cur_steps = 0
         self.max_steps = max_steps
 
-        self.grid = np.zeros((_COLLISION_LAYERS, *self.grid_size), dtype=np.int32)
+        # the collision grid lives inside a zero-padded buffer so that
+        # border sensor windows never need np.pad; self.grid is a view
+        # into the interior and the sensor_range margin stays zero
+        self._padded_grid = np.zeros(
+            (
+                _COLLISION_LAYERS,
+                self.grid_size[0] + 2 * sensor_range,
+                self.grid_size[1] + 2 * sensor_range,
+            ),
+            dtype=np.int32,
+        )
+        self.grid = self._padded_grid[
+            :,
+            sensor_range : sensor_range + self.grid_size[0],
+            sensor_range : sensor_range + self.grid_size[1],
+        ]
+
+        # precomputed highway map; _is_highway is a pure function of (x, y)
+        xs, ys = np.meshgrid(
+            np.arange(self.grid_size[1]), np.arange(self.grid_size[0])
+        )
+        self._highway = (
+            (xs % 3 == 0)  # vertical highways
+            | (ys % 9 == 0)  # horizontal highways
+            | (ys == self.grid_size[0] - 1)  # delivery row
+            | (  # remove a box for queuing
+                (ys > self.grid_size[0] - 11)
+                & ((xs == self.grid_size[1] // 2 - 1) | (xs == self.grid_size[1] // 2))
+            )
+        )
 
         sa_action_space = [len(Action), *msg_bits * (2,)]
         if len(sa_action_space) == 1:
@@ -227,8 +406,10 @@ class Warehouse(gym.Env):
         self.request_queue_size = request_queue_size
         self.request_queue = []
 
-        self.requested_delivered_shelf = []
-        self.carried_shelf = []
+        # delivered and carried shelves are tracked as sets so membership
+        # tests, removals and dedup in step() are O(1) instead of list scans
+        self.requested_delivered_shelf = set()
+        self.carried_shelf = set()
 
         # self.carried_delivered_shelf = []
         # self.carried_requested_shelf = []        
@@ -257,6 +438,7 @@ class Warehouse(gym.Env):
         # ]
 
         self.goals: List[Tuple[int, int]] = [(i, self.grid_size[0] - 1) for i in range(self.grid_size[1])]
+        self._goals_xy = np.asarray(self.goals, dtype=np.int64)
 
         self._obs_bits_for_self = 4 + len(Direction)
         self._obs_bits_per_agent = 1 + len(Direction) + self.msg_bits
@@ -271,6 +453,23 @@ class Warehouse(gym.Env):
             + self._obs_sensor_locations * self._obs_bits_per_shelf
         )
 
+        # lookup tables and SoA mirrors for the vectorized fast-obs path
+        self._dir_onehot = np.eye(len(Direction), dtype=np.float32)
+        self._agent_xy = np.zeros((n_agents, 2), dtype=np.int64)
+        self._agent_dirs = np.zeros(n_agents, dtype=np.int8)
+        self._agent_msgs = np.zeros((n_agents, msg_bits), dtype=np.float32)
+        self._obs_buffer = np.zeros((n_agents, self._obs_length), dtype=np.float32)
+        self._requested_cell_mask = np.zeros(self.grid_size, dtype=np.bool_)
+
+        # the done flags are all-or-nothing, so reuse two constant lists
+        # instead of allocating n_agents booleans every step
+        self._dones_false = n_agents * [False]
+        self._dones_true = n_agents * [True]
+        self._rewards_buf = np.zeros(n_agents, dtype=np.float32)
+        # requested ids/coordinates are recomputed only when the queue or a
+        # requested shelf's position changed since they were last built
+        self._requested_coords_dirty = True
+
         # default values:
         self.fast_obs = None
         self.observation_space = None
@@ -283,6 +482,27 @@ class Warehouse(gym.Env):
 
         self.renderer = None
 
+        if njit is not None:
+            # trigger JIT compilation here rather than on the first step()
+            _resolve_conflicts(
+                np.full(1, -1, dtype=np.int64), np.zeros(1, dtype=np.int64), 1
+            )
+            _fill_obs(
+                self._padded_grid[_LAYER_AGENTS],
+                self._padded_grid[_LAYER_SHELFS],
+                self._highway,
+                self._agent_xy[:, 0],
+                self._agent_xy[:, 1],
+                self._agent_dirs,
+                self._agent_msgs,
+                np.zeros(n_agents, dtype=np.float32),
+                np.zeros(1, dtype=np.bool_),
+                2 * sensor_range + 1,
+                self._obs_bits_for_self,
+                self._obs_buffer,
+            )
+            self._obs_buffer[:] = 0
+
     def _use_slow_obs(self):
         self.fast_obs = False
         self.observation_space = spaces.Tuple(
@@ -340,95 +560,142 @@ class Warehouse(gym.Env):
             return
 
         self.fast_obs = True
-        ma_spaces = []
-        for sa_obs in self.observation_space:
-            flatdim = spaces.flatdim(sa_obs)
-            ma_spaces += [
-                spaces.Box(
-                    low=-float("inf"),
-                    high=float("inf"),
-                    shape=(flatdim,),
-                    dtype=np.float32,
-                )
-            ]
+        # the emitted vectors are _obs_length floats (the slow Dict space's
+        # flatdim is larger because it one-hot-encodes the location), so the
+        # declared Box must match what _make_obs actually writes
+        ma_spaces = [
+            spaces.Box(
+                low=-float("inf"),
+                high=float("inf"),
+                shape=(self._obs_length,),
+                dtype=np.float32,
+            )
+            for _ in range(self.n_agents)
+        ]
 
         self.observation_space = spaces.Tuple(tuple(ma_spaces))
 
     def _is_highway(self, x: int, y: int) -> bool:
-        return (
-            (x % 3 == 0)  # vertical highways
-            or (y % 9 == 0)  # horizontal highways
-            or (y == self.grid_size[0] - 1)  # delivery row
-            or (  # remove a box for queuing
-                (y > self.grid_size[0] - 11)
-                and ((x == self.grid_size[1] // 2 - 1) or (x == self.grid_size[1] // 2))
-            )
-        )
+        return bool(self._highway[y, x])
 
-    def _make_obs(self, agent):
+    def _make_obs_all(self):
+        """Build the observations of all agents in one batched pass.
 
-        y_scale, x_scale = self.grid_size[0] - 1, self.grid_size[1] - 1
+        Only the fast-obs encoding can be batched; the dict-based slow
+        obs falls back to per-agent construction.
 
-        min_x = agent.x - self.sensor_range
-        max_x = agent.x + self.sensor_range + 1
+        The returned tuple holds views into a buffer that is rewritten
+        on the next step/reset; consumers that keep observations across
+        steps must copy them.
+        """
+        if not self.fast_obs:
+            return tuple(self._make_obs(agent) for agent in self.agents)
 
-        min_y = agent.y - self.sensor_range
-        max_y = agent.y + self.sensor_range + 1
-        # sensors
-        if (
-            (min_x < 0)
-            or (min_y < 0)
-            or (max_x > self.grid_size[1])
-            or (max_y > self.grid_size[0])
-        ):
-            padded_agents = np.pad(
-                self.grid[_LAYER_AGENTS], self.sensor_range, mode="constant"
+        win_size = 2 * self.sensor_range + 1
+        ys, xs = self._agent_xy[:, 0], self._agent_xy[:, 1]
+
+        if njit is not None:
+            carry = np.fromiter(
+                (agent.carrying_shelf is not None for agent in self.agents),
+                dtype=np.float32,
+                count=self.n_agents,
             )
-            padded_shelfs = np.pad(
-                self.grid[_LAYER_SHELFS], self.sensor_range, mode="constant"
+            _fill_obs(
+                self._padded_grid[_LAYER_AGENTS],
+                self._padded_grid[_LAYER_SHELFS],
+                self._highway,
+                ys,
+                xs,
+                self._agent_dirs,
+                self._agent_msgs,
+                carry,
+                self._requested,
+                win_size,
+                self._obs_bits_for_self,
+                self._obs_buffer,
             )
-            # + self.sensor_range due to padding
-            min_x += self.sensor_range
-            max_x += self.sensor_range
-            min_y += self.sensor_range
-            max_y += self.sensor_range
+            return tuple(self._obs_buffer)
 
-        else:
-            padded_agents = self.grid[_LAYER_AGENTS]
-            padded_shelfs = self.grid[_LAYER_SHELFS]
+        # (2, H, W, K, K) zero-copy windows; in padded coordinates the
+        # window around (x, y) starts at (y, x) itself
+        windows = np.lib.stride_tricks.sliding_window_view(
+            self._padded_grid, (win_size, win_size), axis=(1, 2)
+        )
+        agents = windows[_LAYER_AGENTS, ys, xs].reshape(self.n_agents, -1)
+        shelfs = windows[_LAYER_SHELFS, ys, xs].reshape(self.n_agents, -1)
+
+        obs = self._obs_buffer
+        obs[:, 0] = xs
+        obs[:, 1] = ys
+        obs[:, 2] = [int(agent.carrying_shelf is not None) for agent in self.agents]
+        obs[:, 3:7] = self._dir_onehot[self._agent_dirs]
+        obs[:, 7] = self._highway[ys, xs]
+
+        has_agent = (agents != 0)[:, :, np.newaxis]
+        dirs = np.where(has_agent[:, :, 0], self._agent_dirs[agents - 1], 0)
+        agent_block = np.concatenate(
+            [
+                has_agent.astype(np.float32),
+                self._dir_onehot[dirs],
+                self._agent_msgs[agents - 1] * has_agent,
+            ],
+            axis=2,
+        )
+
+        has_shelf = shelfs != 0
+        shelf_block = np.stack(
+            [has_shelf, has_shelf & self._requested[shelfs]], axis=2
+        ).astype(np.float32)
+
+        obs[:, self._obs_bits_for_self :] = np.concatenate(
+            [agent_block, shelf_block], axis=2
+        ).reshape(self.n_agents, -1)
+
+        return tuple(obs)
+
+    def _make_obs(self, agent):
 
-        agents = padded_agents[min_y:max_y, min_x:max_x].reshape(-1)
-        shelfs = padded_shelfs[min_y:max_y, min_x:max_x].reshape(-1)
+        # sensors: in padded coordinates the window around (x, y) starts
+        # at (x, y) itself, so border windows read the zero margin
+        win_size = 2 * self.sensor_range + 1
+        agents = self._padded_grid[
+            _LAYER_AGENTS, agent.y : agent.y + win_size, agent.x : agent.x + win_size
+        ].reshape(-1)
+        shelfs = self._padded_grid[
+            _LAYER_SHELFS, agent.y : agent.y + win_size, agent.x : agent.x + win_size
+        ].reshape(-1)
 
         if self.fast_obs:
-            obs = _VectorWriter(self.observation_space[agent.id - 1].shape[0])
-
-            obs.write([agent.x, agent.y, int(agent.carrying_shelf is not None)])
-            direction = np.zeros(4)
-            direction[agent.dir.value] = 1.0
-            obs.write(direction)
-            obs.write([int(self._is_highway(agent.x, agent.y))])
-
-            for i, (id_agent, id_shelf) in enumerate(zip(agents, shelfs)):
-                if id_agent == 0:
-                    obs.skip(1)
-                    obs.write([1.0])
-                    obs.skip(3 + self.msg_bits)
-                else:
-                    obs.write([1.0])
-                    direction = np.zeros(4)
-                    direction[self.agents[id_agent - 1].dir.value] = 1.0
-                    obs.write(direction)
-                    if self.msg_bits > 0:
-                        obs.write(self.agents[id_agent - 1].message)
-                if id_shelf == 0:
-                    obs.skip(2)
-                else:
-                    obs.write(
-                        [1.0, int(self.shelfs[id_shelf - 1] in self.request_queue)]
-                    )
+            obs = self._obs_buffer[agent.id - 1]
+
+            obs[0:3] = (agent.x, agent.y, int(agent.carrying_shelf is not None))
+            obs[3:7] = self._dir_onehot[agent.dir.value]
+            obs[7] = int(self._is_highway(agent.x, agent.y))
+
+            # agent block: has_agent bit, direction one-hot, message bits
+            # (empty cells keep the direction-0 one-hot, like the slow obs)
+            has_agent = (agents != 0)[:, np.newaxis]
+            dirs = np.where(has_agent[:, 0], self._agent_dirs[agents - 1], 0)
+            agent_block = np.concatenate(
+                [
+                    has_agent.astype(np.float32),
+                    self._dir_onehot[dirs],
+                    self._agent_msgs[agents - 1] * has_agent,
+                ],
+                axis=1,
+            )
+
+            # shelf block: has_shelf bit, shelf_requested bit
+            has_shelf = shelfs != 0
+            shelf_block = np.stack(
+                [has_shelf, has_shelf & self._requested[shelfs]], axis=1
+            ).astype(np.float32)
 
-            return obs.vector
+            obs[self._obs_bits_for_self :] = np.concatenate(
+                [agent_block, shelf_block], axis=1
+            ).reshape(-1)
+
+            return obs
 
         # --- self data
         obs = {}
@@ -459,19 +726,57 @@ class Warehouse(gym.Env):
                 obs["sensors"][i]["shelf_requested"] = [0]
             else:
                 obs["sensors"][i]["has_shelf"] = [1]
-                obs["sensors"][i]["shelf_requested"] = [
-                    int(self.shelfs[id_ - 1] in self.request_queue)
-                ]
+                obs["sensors"][i]["shelf_requested"] = [int(self._requested[id_])]
 
         return obs
 
     def _recalc_grid(self):
+        # rebuild the grid and all SoA mirrors from the entity objects
+        # (tests and wrappers mutate entities directly, so this is the
+        # one place where object state and array state are reconciled)
         self.grid[:] = 0
-        for s in self.shelfs:
-            self.grid[_LAYER_SHELFS, s.y, s.x] = s.id
 
-        for a in self.agents:
-            self.grid[_LAYER_AGENTS, a.y, a.x] = a.id
+        self._requested = np.zeros(len(self.shelfs) + 1, dtype=np.bool_)
+        self._requested[[s.id for s in self.request_queue]] = True
+        self._req_index = {s.id: i for i, s in enumerate(self.request_queue)}
+
+        self._shelf_xy = np.zeros((len(self.shelfs) + 1, 2), dtype=np.int64)
+        self._shelf_xy[1:, 0] = [s.y for s in self.shelfs]
+        self._shelf_xy[1:, 1] = [s.x for s in self.shelfs]
+        self.grid[_LAYER_SHELFS, self._shelf_xy[1:, 0], self._shelf_xy[1:, 1]] = (
+            np.arange(1, len(self.shelfs) + 1)
+        )
+
+        self._agent_xy[:, 0] = [a.y for a in self.agents]
+        self._agent_xy[:, 1] = [a.x for a in self.agents]
+        self.grid[_LAYER_AGENTS, self._agent_xy[:, 0], self._agent_xy[:, 1]] = (
+            np.arange(1, self.n_agents + 1)
+        )
+        self._agent_dirs[:] = [a.dir.value for a in self.agents]
+        if self.msg_bits > 0:
+            self._agent_msgs[:] = [a.message for a in self.agents]
+        # anything may have been mutated before a full rebuild
+        self._requested_coords_dirty = True
+
+    def _move_agents(self, idxs):
+        # incremental counterpart of _recalc_grid for committed FORWARD
+        # moves: only the vacated and entered cells change, so touch just
+        # those instead of rebuilding the whole grid. Clearing all old
+        # cells before writing any new one keeps chains of agents moving
+        # into each other's cells correct regardless of order.
+        for i in idxs:
+            agent = self.agents[i]
+            self.grid[_LAYER_AGENTS, agent.prev_y, agent.prev_x] = 0
+            if agent.carrying_shelf:
+                self.grid[_LAYER_SHELFS, agent.prev_y, agent.prev_x] = 0
+        for i in idxs:
+            agent = self.agents[i]
+            self.grid[_LAYER_AGENTS, agent.y, agent.x] = agent.id
+            self._agent_xy[i] = (agent.y, agent.x)
+            shelf = agent.carrying_shelf
+            if shelf:
+                self.grid[_LAYER_SHELFS, agent.y, agent.x] = shelf.id
+                self._shelf_xy[shelf.id] = (agent.y, agent.x)
 
     def reset(self):
         Shelf.counter = 0
@@ -482,15 +787,9 @@ class Warehouse(gym.Env):
         # n_xshelf = (self.grid_size[1] - 1) // 3
         # n_yshelf = (self.grid_size[0] - 2) // 9
 
-        # make the shelfs
-        self.shelfs = [
-            Shelf(x, y)
-            for y, x in zip(
-                np.indices(self.grid_size)[0].reshape(-1),
-                np.indices(self.grid_size)[1].reshape(-1),
-            )
-            if not self._is_highway(x, y)
-        ]
+        # make the shelfs (row-major order keeps the shelf ids stable)
+        ys, xs = np.where(~self._highway)
+        self.shelfs = [Shelf(int(x), int(y)) for x, y in zip(xs, ys)]
 
         # spawn agents at random locations
         agent_locs = np.random.choice(
@@ -500,25 +799,38 @@ class Warehouse(gym.Env):
         )
         agent_locs = np.unravel_index(agent_locs, self.grid_size)
         # and direction
-        agent_dirs = np.random.choice([d for d in Direction], size=self.n_agents)
+        agent_dirs = np.random.choice(len(Direction), size=self.n_agents)
         self.agents = [
-            Agent(x, y, dir_, self.msg_bits)
+            Agent(x, y, _ALL_DIRECTIONS[dir_], self.msg_bits)
             for y, x, dir_ in zip(*agent_locs, agent_dirs)
         ]
 
+        # each agent's message is a row view into the shared SoA buffer,
+        # so in-place writes (agent.message[:] = ...) need no copying
+        self._agent_msgs[:] = 0
+        for agent, msg_row in zip(self.agents, self._agent_msgs):
+            agent.message = msg_row
+
         self._recalc_grid()
 
         self.shelf_original_coordinates = {s.id:[s.y, s.x] for s in self.shelfs}
+        # same data as an (n_shelfs + 1, 2) array indexed by shelf id, so
+        # the "send shelf home" step reads both coordinates in one access
+        self._shelf_home_yx = self._shelf_xy.copy()
 
         self.shelf_original_dist_goal = \
             {s.id:min(abs(s.x - list(self.goals[0])[0]), abs(s.x - list(self.goals[1])[0])) \
                 + abs(s.y - list(self.goals[0])[1]) for s in self.shelfs}
 
-        self.request_queue = list(
-            np.random.choice(self.shelfs, size=self.request_queue_size, replace=False)
+        queue_idx = np.random.choice(
+            len(self.shelfs), size=self.request_queue_size, replace=False
         )
+        self.request_queue = [self.shelfs[i] for i in queue_idx]
+        self._requested = np.zeros(len(self.shelfs) + 1, dtype=np.bool_)
+        self._requested[[s.id for s in self.request_queue]] = True
+        self._req_index = {s.id: i for i, s in enumerate(self.request_queue)}
 
-        return tuple([self._make_obs(agent) for agent in self.agents])
+        return self._make_obs_all()
         # for s in self.shelfs:
         #     self.grid[0, s.y, s.x] = 1
         # print(self.grid[0])
@@ -526,126 +838,172 @@ class Warehouse(gym.Env):
     
     def _reward(self, pos, goal, d):
         """
-        Compute the reward to be given 
+        Compute the reward to be given
         """
-        if np.linalg.norm(pos - goal, ord=1) < d:
+        dist = abs(int(pos[0]) - int(goal[0])) + abs(int(pos[1]) - int(goal[1]))
+        if dist < d:
             reward = 0
-        else: 
-            reward = - np.linalg.norm(pos - goal, ord=1) / (self.grid_size[0] * self.grid_size[1])
+        else:
+            reward = -dist / (self.grid_size[0] * self.grid_size[1])
         return reward
+
+    def _reward_vec(self, pos, targets, d):
+        """
+        Compute the rewards from one position to a (M, 2) array of targets
+        """
+        dist = np.abs(pos - targets).sum(-1)
+        return np.where(
+            dist < d, 0.0, -dist / (self.grid_size[0] * self.grid_size[1])
+        )
     
     def dist_pos_goal(self, pos, goal):
-        return np.linalg.norm(pos - goal, ord=1)
+        return abs(pos[0] - goal[0]) + abs(pos[1] - goal[1])
+
+    def _apply_reward_global(self, rewards, agent_idx, value):
+        rewards += value
+
+    def _apply_reward_individual(self, rewards, agent_idx, value):
+        rewards[agent_idx] += value
 
+    def _apply_reward_two_stage(self, rewards, agent_idx, value):
+        # two-stage pays half on pickup and half again on delivery
+        self.agents[agent_idx].has_delivered = True
+        rewards[agent_idx] += value / 2
 
-    def shelf_ids_coordinates(self, shelf_list):
+    def _pairwise_dist(self, a, b):
         """
-        Compute the shelf ids and their coordinates
+        Manhattan distance matrix between (N, 2) and (M, 2) coordinate arrays
         """
-        ids = [shelf.id for shelf in shelf_list]
-        coordinates = \
-            [np.concatenate(np.where(self.grid[_LAYER_SHELFS] == shelf_id)) for shelf_id in ids]
-        return ids, coordinates
+        a = np.asarray(a)
+        b = np.asarray(b)
+        return np.abs(a[:, None, :] - b[None, :, :]).sum(-1)
+
+
+    def _shelf_group(self, mask):
+        """
+        Materialize a shelf-id mask as (shelves, ids, coordinates)
+        """
+        ids = np.nonzero(mask)[0]
+        shelf_list = [self.shelfs[i - 1] for i in ids]
+        return shelf_list, list(ids), list(self._shelf_xy[ids])
 
-    
     def update_shelf_properties(self):
-        ## Shelves can be (1) requested or unrequested; (2) carried or uncarried; 
+        ## Shelves can be (1) requested or unrequested; (2) carried or uncarried;
         ## (3) delivered or undelivered (for requested only)
+        ## All groups are boolean masks indexed by shelf id; coordinates
+        ## come from the _shelf_xy SoA instead of scanning the grid
+
+        requested = self._requested
+        carried = np.zeros_like(requested)
+        carried[[s.id for s in self.carried_shelf if s is not None]] = True
+        delivered = np.zeros_like(requested)
+        delivered[[s.id for s in self.requested_delivered_shelf]] = True
+        self._carried = carried
+        self._delivered = delivered
+
+        if self._requested_coords_dirty:
+            self.requested_shelf_ids = [s.id for s in self.request_queue]
+            self.requested_shelf_coordinates = list(
+                self._shelf_xy[self.requested_shelf_ids]
+            )
+            self._requested_coords_dirty = False
 
-        self.requested_shelf_ids, self.requested_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.request_queue)
-        # print("requested:", self.requested_shelf_ids)
-        
-
-        self.unrequested_shelf = list(set(self.shelfs) - set(self.request_queue))
-        self.unrequested_shelf_ids, self.unrequested_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.unrequested_shelf)
-        # print("unrequested:", self.requested_shelf_ids) 
-        
+        unrequested = ~requested
+        unrequested[0] = False
+        (
+            self.unrequested_shelf,
+            self.unrequested_shelf_ids,
+            self.unrequested_shelf_coordinates,
+        ) = self._shelf_group(unrequested)
 
         ## *** update in each step
         if not len(self.requested_delivered_shelf):
-            self.requested_delivered_shelf_ids, self.requested_delivered_shelf_coordinates = \
-                self.shelf_ids_coordinates(self.requested_delivered_shelf)
-        else: 
+            self.requested_delivered_shelf_ids = []
+            self.requested_delivered_shelf_coordinates = []
+        else:
             self.requested_delivered_shelf_ids, self.requested_delivered_shelf_coordinates = None, None
-        # print("requested and delivered", self.requested_delivered_shelf_ids)
-        
 
-        self.requested_undelivered_shelf = list(set(self.request_queue) - set(self.requested_delivered_shelf))
-        self.requested_undelivered_shelf_ids, self.requested_undelivered_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.requested_undelivered_shelf)
-        # print("requested and undelivered", self.requested_undelivered_shelf_ids)
-        
+        requested_undelivered = requested & ~delivered
+        (
+            self.requested_undelivered_shelf,
+            self.requested_undelivered_shelf_ids,
+            self.requested_undelivered_shelf_coordinates,
+        ) = self._shelf_group(requested_undelivered)
 
         ## *** update in each step
         if not len(self.carried_shelf):
-            self.carried_shelf_ids, self.carried_shelf_coordinates = \
-                self.shelf_ids_coordinates(self.carried_shelf)
+            self.carried_shelf_ids = []
+            self.carried_shelf_coordinates = []
         else:
             self.carried_shelf_ids, self.carried_shelf_coordinates = None, None
-        # print("carried", self.carried_shelf_ids)
-
-
-        self.uncarried_shelf = list(set(self.shelfs) - set(self.carried_shelf))
-        self.uncarried_shelf_ids, self.unrcarried_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.uncarried_shelf)
-        # print("uncarried", self.uncarried_shelf_ids)
-
-
-
-        self.carried_delivered_shelf = list(set(self.carried_shelf) & set(self.requested_delivered_shelf))  
-        self.carried_delivered_shelf_ids, self.carried_delivered_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.carried_delivered_shelf)   
-        # print("carried and delivered:", self.carried_delivered_shelf_ids)
 
-        self.carried_undelivered_shelf = list(set(self.carried_shelf) & set(self.requested_undelivered_shelf))  
-        self.carried_undelivered_shelf_ids, self.carried_delivered_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.carried_undelivered_shelf)
-        # print("carried and undelivered:", self.carried_undelivered_shelf_ids)
-
-
-        self.uncarried_delivered_shelf = list(set(self.requested_delivered_shelf) - set(self.carried_delivered_shelf)) 
-        self.uncarried_delivered_shelf_ids, self.uncarried_delivered_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.uncarried_delivered_shelf)
-        # print("uncarried and delivered:", self.uncarried_delivered_shelf_ids)
-        
-
-        self.uncarried_undelivered_shelf = list(set(self.requested_undelivered_shelf) - set(self.uncarried_delivered_shelf)) 
-        self.uncarried_undelivered_shelf_ids, self.uncarried_undelivered_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.uncarried_undelivered_shelf)
-        # print("uncarried and undelivered:", self.uncarried_undelivered_shelf_ids)
-        
-
-        self.carried_requested_shelf = list(set(self.carried_shelf) & set(self.requested_undelivered_shelf)) 
-        self.carried_requested_shelf_ids, self.carried_requested_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.carried_requested_shelf)
-        # self.carried_requested_shelf_ids = [shelf.id for shelf in self.carried_request_shelf]
-        # print("carried and requested:", self.carried_requested_shelf_ids)
-
-
-        self.uncarried_requested_shelf = list(set(self.uncarried_shelf) & set(self.requested_undelivered_shelf)) 
-        self.uncarried_requested_shelf_ids, self.uncarried_requested_shelf_coordinates = \
-            self.shelf_ids_coordinates(self.uncarried_requested_shelf)
-        # print("uncarried and requested:", self.uncarried_requested_shelf_ids)
+        uncarried = ~carried
+        uncarried[0] = False
+        (
+            self.uncarried_shelf,
+            self.uncarried_shelf_ids,
+            self.uncarried_shelf_coordinates,
+        ) = self._shelf_group(uncarried)
+
+        (
+            self.carried_delivered_shelf,
+            self.carried_delivered_shelf_ids,
+            self.carried_delivered_shelf_coordinates,
+        ) = self._shelf_group(carried & delivered)
+
+        (
+            self.carried_undelivered_shelf,
+            self.carried_undelivered_shelf_ids,
+            self.carried_undelivered_shelf_coordinates,
+        ) = self._shelf_group(carried & requested_undelivered)
+
+        uncarried_delivered = delivered & ~carried
+        (
+            self.uncarried_delivered_shelf,
+            self.uncarried_delivered_shelf_ids,
+            self.uncarried_delivered_shelf_coordinates,
+        ) = self._shelf_group(uncarried_delivered)
+
+        (
+            self.uncarried_undelivered_shelf,
+            self.uncarried_undelivered_shelf_ids,
+            self.uncarried_undelivered_shelf_coordinates,
+        ) = self._shelf_group(requested_undelivered & ~uncarried_delivered)
+
+        (
+            self.carried_requested_shelf,
+            self.carried_requested_shelf_ids,
+            self.carried_requested_shelf_coordinates,
+        ) = self._shelf_group(carried & requested_undelivered)
+
+        (
+            self.uncarried_requested_shelf,
+            self.uncarried_requested_shelf_ids,
+            self.uncarried_requested_shelf_coordinates,
+        ) = self._shelf_group(uncarried & requested_undelivered)
 
 
     def nonsparse_reward(self, agent, pos, goals, dist, rewards):
     ## Add the newly designed rewards (non-sparse)            
         if agent.carrying_shelf:
-            if agent.carrying_shelf in self.carried_undelivered_shelf:
-                if agent.carrying_shelf in self.request_queue:
+            shelf_id = agent.carrying_shelf.id
+            # carried & requested & undelivered, as one mask read each
+            if (
+                self._carried[shelf_id]
+                and self._requested[shelf_id]
+                and not self._delivered[shelf_id]
+            ):
+                if self._requested[shelf_id]:
                     ## Carrying a requested shelf which is undelivered
                     ## Go to the goal location ASAP
+                    reward = self._reward_vec(pos, np.asarray(goals), dist).max()
                     if self.reward_type == RewardType.GLOBAL:
-                        rewards += max([self._reward(pos, goal, dist) for goal in goals])
+                        rewards += reward
                     elif self.reward_type == RewardType.INDIVIDUAL:
-                        agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                        rewards[agent_id - 1] += max([self._reward(pos, goal, dist) for goal in goals])
+                        rewards[agent.id - 1] += reward
                     elif self.reward_type == RewardType.TWO_STAGE:
-                        agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                        rewards[agent_id - 1] += max([self._reward(pos, goal, dist) for goal in goals])
-                # else: 
+                        rewards[agent.id - 1] += reward
+                # else:
                 #     ## Carrying an unrequested shelf (which is definitely undelivered)
                 #     ## Undesirable behavior; assign negative reward
                 #     if self.reward_type == RewardType.GLOBAL:
@@ -660,34 +1018,29 @@ class Warehouse(gym.Env):
                 ## Carrying a delivered shelf
                 ## Return the delivered shelf to an empty shelf location ASAP
                 if len(self.carried_requested_shelf):
-                    reward = max([self._reward(pos, coord, dist) \
-                        for coord in (self.carried_requested_shelf_coordinates)])
-                else: 
+                    reward = self._reward_vec(
+                        pos, np.asarray(self.carried_requested_shelf_coordinates), dist
+                    ).max()
+                else:
                     reward = 0
                 if self.reward_type == RewardType.GLOBAL:
                     rewards += reward
                 elif self.reward_type == RewardType.INDIVIDUAL:
-                    agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                    rewards[agent_id - 1] += reward
+                    rewards[agent.id - 1] += reward
                 elif self.reward_type == RewardType.TWO_STAGE:
-                    agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                    rewards[agent_id - 1] += reward                                                   
-        else: 
+                    rewards[agent.id - 1] += reward
+        else:
             ## Not carrying any shelf
             ## Go to the closest uncarried requested shelf ASAP
-            # if len(self.uncarried_request_shelf_ids):
-            #     reward = max([self._reward(pos, coord, dist) for coord in self.uncarried_requested_shelf_coordinates])
-            # else: 
-            #     reward = 0
-            reward = max([self._reward(pos, coord, dist) for coord in self.uncarried_requested_shelf_coordinates])
+            reward = self._reward_vec(
+                pos, np.asarray(self.uncarried_requested_shelf_coordinates), dist
+            ).max()
             if self.reward_type == RewardType.GLOBAL:
                 rewards += reward
             elif self.reward_type == RewardType.INDIVIDUAL:
-                agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                rewards[agent_id - 1] += reward
+                rewards[agent.id - 1] += reward
             elif self.reward_type == RewardType.TWO_STAGE:
-                agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                rewards[agent_id - 1] += reward
+                rewards[agent.id - 1] += reward
 
         return rewards
 
@@ -709,11 +1062,10 @@ class Warehouse(gym.Env):
 
         # # forward agents will move only if they avoid collisions
         # forward_agents = [agent for agent in self.agents if agent.action == Action.FORWARD]
-        commited_agents = set()
-
-        G = nx.DiGraph()
+        next_idx = np.empty(self.n_agents, dtype=np.int64)
+        sink_key = np.empty(self.n_agents, dtype=np.int64)
 
-        for agent in self.agents:
+        for i, agent in enumerate(self.agents):
             start = agent.x, agent.y
             target = agent.req_location(self.grid_size)
 
@@ -732,46 +1084,31 @@ class Warehouse(gym.Env):
                 # our agent is carrying a shelf so there's no way
                 # this movement can succeed. Cancel it.
                 agent.req_action = Action.NOOP
-                G.add_edge(start, start)
-            else:
-                G.add_edge(start, target)
-
-        wcomps = [G.subgraph(c).copy() for c in nx.weakly_connected_components(G)]
-
-        for comp in wcomps:
-            try:
-                # if we find a cycle in this component we have to
-                # commit all nodes in that cycle, and nothing else
-                cycle = nx.algorithms.find_cycle(comp)
-                if len(cycle) == 2:
-                    # we have a situation like this: [A] <-> [B]
-                    # which is physically impossible. so skip
-                    continue
-                for edge in cycle:
-                    start_node = edge[0]
-                    agent_id = self.grid[_LAYER_AGENTS, start_node[1], start_node[0]]
-                    if agent_id > 0:
-                        commited_agents.add(agent_id)
-            except nx.NetworkXNoCycle:
-
-                longest_path = nx.algorithms.dag_longest_path(comp)
-                for x, y in longest_path:
-                    agent_id = self.grid[_LAYER_AGENTS, y, x]
-                    if agent_id:
-                        commited_agents.add(agent_id)
-
-        commited_agents = set([self.agents[id_ - 1] for id_ in commited_agents])
+                target = start
+
+            # the agent currently standing on our target cell (or -1)
+            next_idx[i] = self.grid[_LAYER_AGENTS, target[1], target[0]] - 1
+            sink_key[i] = target[1] * self.grid_size[1] + target[0]
+
+        committed = _resolve_conflicts(
+            next_idx, sink_key, self.grid_size[0] * self.grid_size[1]
+        )
+
+        commited_agents = set(
+            agent for i, agent in enumerate(self.agents) if committed[i]
+        )
         failed_agents = set(self.agents) - commited_agents
 
         for agent in failed_agents:
             assert agent.req_action == Action.FORWARD
             agent.req_action = Action.NOOP
 
-        rewards = np.zeros(self.n_agents)
+        rewards = self._rewards_buf
+        rewards[:] = 0
         
 
         
-        goals = np.array([list(self.goals[0]), list(self.goals[1])]) # coordinates of the goal locations
+        goals = self._goals_xy[:2]  # coordinates of the goal locations
         # dist = self.grid_size[0] * self.grid_size[1]
         # dist = 0
 
@@ -781,76 +1118,95 @@ class Warehouse(gym.Env):
             
         self._recalc_grid()
 
-        _, self.requested_shelf_coordinates = self.shelf_ids_coordinates(self.request_queue)
-        self.requested_shelf_coordinates_tuple = [tuple(coord) for coord in self.requested_shelf_coordinates]
+        self.requested_shelf_ids = [s.id for s in self.request_queue]
+        requested_xy = self._shelf_xy[self.requested_shelf_ids]
+        self.requested_shelf_coordinates = list(requested_xy)
+        self._requested_coords_dirty = False
+        # boolean grid of requested-shelf cells: the TOGGLE_LOAD test below
+        # becomes a single array read, with no tuple hashing at all
+        self._requested_cell_mask[:] = False
+        self._requested_cell_mask[requested_xy[:, 0], requested_xy[:, 1]] = True
 
         for agent in self.agents:
             agent.prev_x, agent.prev_y = agent.x, agent.y
 
-            if agent.req_action == Action.FORWARD:
-                agent.x, agent.y = agent.req_location(self.grid_size)
-                if agent.carrying_shelf:
-                    agent.carrying_shelf.x, agent.carrying_shelf.y = agent.x, agent.y                
-            elif agent.req_action in [Action.LEFT, Action.RIGHT]:
-                agent.dir = agent.req_direction()
-            # elif agent.req_action == Action.TOGGLE_LOAD and not agent.carrying_shelf:
-            elif agent.req_action == Action.TOGGLE_LOAD and not agent.carrying_shelf \
-                and (agent.y, agent.x) in self.requested_shelf_coordinates_tuple:
+        # one dispatch per action kind instead of per agent: group the
+        # agents by requested action and skip the NOOPs entirely (the
+        # branches are independent across agents, so order doesn't matter)
+        req = np.fromiter(
+            (agent.req_action.value for agent in self.agents),
+            dtype=np.int8,
+            count=self.n_agents,
+        )
+
+        forward_idx = np.flatnonzero(req == Action.FORWARD.value)
+        for i in forward_idx:
+            agent = self.agents[i]
+            agent.x, agent.y = agent.req_location(self.grid_size)
+            if agent.carrying_shelf:
+                agent.carrying_shelf.x, agent.carrying_shelf.y = agent.x, agent.y
+                if self._requested[agent.carrying_shelf.id]:
+                    self._requested_coords_dirty = True
+
+        for i in np.flatnonzero(
+            (req == Action.LEFT.value) | (req == Action.RIGHT.value)
+        ):
+            agent = self.agents[i]
+            agent.dir = agent.req_direction()
+            self._agent_dirs[i] = agent.dir.value
+
+        for i in np.flatnonzero(req == Action.TOGGLE_LOAD.value):
+            agent = self.agents[i]
+            if not agent.carrying_shelf \
+                and self._requested_cell_mask[agent.y, agent.x]:
                 shelf_id = self.grid[_LAYER_SHELFS, agent.y, agent.x]
                 if shelf_id:
                     agent.carrying_shelf = self.shelfs[shelf_id - 1]
-                if agent.carrying_shelf and agent.carrying_shelf in self.request_queue:                     
-                    if self.reward_type == RewardType.GLOBAL:
-                        rewards += 1
-                    elif self.reward_type == RewardType.INDIVIDUAL:
-                        agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                        rewards[agent_id - 1] += 1
-                    elif self.reward_type == RewardType.TWO_STAGE:
-                        agent_id = self.grid[_LAYER_AGENTS, agent.y, agent.x]
-                        self.agents[agent_id - 1].has_delivered = True          
-                        rewards[agent_id - 1] += 0.5 
-                self.carried_shelf.append(agent.carrying_shelf)               
-            elif agent.req_action == Action.TOGGLE_LOAD and agent.carrying_shelf:           
-                if not self._is_highway(agent.x, agent.y): 
+                if agent.carrying_shelf and self._requested[agent.carrying_shelf.id]:
+                    # the agent on this cell is `agent` itself; no need to
+                    # look its id up through the grid again
+                    self._apply_reward(rewards, agent.id - 1, 1)
+                self.carried_shelf.add(agent.carrying_shelf)
+            elif agent.carrying_shelf:
+                if not self._is_highway(agent.x, agent.y):
                     # if (agent.x, agent.y) == self.goals and agent.carrying_shelf in self.carried_delivered_shelf:
-                    #     self.carried_delivered_shelf.remove(agent.carrying_shelf)  
+                    #     self.carried_delivered_shelf.remove(agent.carrying_shelf)
                     #     self.uncarried_delivered_shelf.append(agent.carrying_shelf)
-                    if agent.carrying_shelf not in self.request_queue: 
-                        self.carried_shelf.remove(agent.carrying_shelf)         
-                        agent.carrying_shelf = None           
-                    ## might need to change this         
+                    if not self._requested[agent.carrying_shelf.id]:
+                        self.carried_shelf.remove(agent.carrying_shelf)
+                        agent.carrying_shelf = None
+                    ## might need to change this
                     # if agent.has_delivered and self.reward_type == RewardType.TWO_STAGE:
                     #     rewards[agent.id - 1] += 0.5 * 2
-                        # rewards[agent.id - 1] += (1 - 0.9 * self._cur_steps / self.max_steps) / 2                   
-                    agent.has_delivered = False          
-            
+                        # rewards[agent.id - 1] += (1 - 0.9 * self._cur_steps / self.max_steps) / 2
+                    agent.has_delivered = False
+
             # if agent.carrying_shelf:
             #     carry_shelf_id, _ = self.shelf_original_coordinates([agent.carrying_shelf])
             #     carrying_shelf_y = self.shelf_original_coordinates[carry_shelf_id]
             #     carrying_shelf_x = self.shelf_original_coordinates[carry_shelf_id]
 
-        
-            
             # self.update_shelf_properties()
             # rewards = self.nonsparse_reward(agent, pos, goals, dist, rewards)
 
-
-
-        self._recalc_grid()
+        # the full rebuild above already reconciled external mutations;
+        # within the step only the FORWARD agents changed cells
+        self._move_agents(forward_idx)
 
 
 
         
 
         shelf_delivered = False
-        for x, y in self.goals:
-            shelf_id = self.grid[_LAYER_SHELFS, y, x]
-            if not shelf_id:
-                continue
+        # gather the shelf ids sitting on all goal cells in one indexed read;
+        # _requested[0] is always False, so empty cells fall out of the mask
+        goal_shelf_ids = self.grid[
+            _LAYER_SHELFS, self._goals_xy[:, 1], self._goals_xy[:, 0]
+        ]
+        for goal_i in np.nonzero(self._requested[goal_shelf_ids])[0]:
+            x, y = self.goals[goal_i]
+            shelf_id = int(goal_shelf_ids[goal_i])
             shelf = self.shelfs[shelf_id - 1]
-
-            if shelf not in self.request_queue:
-                continue
             # a shelf was successfully delivered.
             shelf_delivered = True
 
@@ -858,52 +1214,51 @@ class Warehouse(gym.Env):
             ###
             self.carried_shelf.remove(shelf)
 
-            for agent in self.agents:
-                if agent.carrying_shelf and (agent.carrying_shelf.x, agent.carrying_shelf.y) == (x, y):                    
-                    agent.has_delivered = True
-                    agent.carrying_shelf = None
-                    
-
-            self.grid[_LAYER_SHELFS, y, x] = 0     
-            shelf.y = self.shelf_original_coordinates[shelf_id][0]
-            shelf.x = self.shelf_original_coordinates[shelf_id][1]
+            # the carrier (if any) is the agent standing on the goal cell;
+            # read it off the agent layer instead of scanning all agents
+            carrier_id = self.grid[_LAYER_AGENTS, y, x]
+            if carrier_id:
+                carrier = self.agents[carrier_id - 1]
+                if carrier.carrying_shelf is shelf:
+                    carrier.has_delivered = True
+                    carrier.carrying_shelf = None
+
+            self.grid[_LAYER_SHELFS, y, x] = 0
+            shelf.y, shelf.x = map(int, self._shelf_home_yx[shelf_id])
             self.grid[_LAYER_SHELFS, shelf.y, shelf.x] = shelf_id
+            self._shelf_xy[shelf_id] = (shelf.y, shelf.x)
             
             
             # print(self.grid[_LAYER_SHELFS, self.shelf_original_coordinates[shelf_id][0], self.shelf_original_coordinates[shelf_id][1]])
             # print(self.grid[_LAYER_SHELFS])
 
-            self.requested_delivered_shelf.append(shelf)
-            self.requested_delivered_shelf = list(set(self.requested_delivered_shelf))
+            self.requested_delivered_shelf.add(shelf)
 
             
             # self.carried_delivered_shelf.append(shelf)
             # self.carried_delivered_shelf = list(set(self.carried_delivered_shelf))
-            # remove from queue and replace it
-            new_request = np.random.choice(
-                list(set(self.shelfs) - set(self.request_queue))
-            )
+            # remove from queue and replace it; sample the replacement from
+            # the _requested bitmap instead of building two shelf sets
+            free_ids = np.flatnonzero(~self._requested[1:]) + 1
+            new_request = self.shelfs[
+                free_ids[np.random.randint(len(free_ids))] - 1
+            ]
 
             # if shelf in self.carried_requested_shelf:
             #     self.carried_requested_shelf.remove(shelf) 
 
-            self.request_queue[self.request_queue.index(shelf)] = new_request
+            self.request_queue[self._req_index[shelf.id]] = new_request
+            self._req_index[new_request.id] = self._req_index.pop(shelf.id)
+            self._requested[shelf.id] = False
+            self._requested[new_request.id] = True
+            self._requested_coords_dirty = True
 
             # Also reward the agents based on negative distances
             # **originally only reward the agents when the shelf has been delivered**
             ## Keep the following sparse rewards
 
-            if self.reward_type == RewardType.GLOBAL:
-                # rewards += 1 - 0.9 * self._cur_steps / self.max_steps
-                rewards += 1 * 2
-            elif self.reward_type == RewardType.INDIVIDUAL:
-                agent_id = self.grid[_LAYER_AGENTS, y, x]
-                rewards[agent_id - 1] += 1 * 2
-                # rewards[agent_id - 1] += 1 - 0.9 * self._cur_steps / self.max_steps
-            elif self.reward_type == RewardType.TWO_STAGE:
-                agent_id = self.grid[_LAYER_AGENTS, y, x]
-                self.agents[agent_id - 1].has_delivered = True
-                rewards[agent_id - 1] += 0.5 * 2         
+            # rewards += 1 - 0.9 * self._cur_steps / self.max_steps
+            self._apply_reward(rewards, carrier_id - 1, 1 * 2)
                 # rewards[agent_id - 1] += (1 - 0.9 * self._cur_steps / self.max_steps) / 2
 
         self.update_shelf_properties()
@@ -919,13 +1274,14 @@ class Warehouse(gym.Env):
         # self.n_uncarried_requested_shelves = len(self.uncarried_requested_shelf)
         
 
-        self.dist_empty_agents_uncarried_requested_shelves = \
-            np.array([[self.dist_pos_goal(np.array([agent.y, agent.x]), coord) for agent in self.empty_agents]\
-                 for coord in self.uncarried_requested_shelf_coordinates])
-        
-        self.dist_goals_uncarried_requested_shelves = \
-            np.array([min([self.dist_pos_goal(goal, coord) for goal in goals])\
-                 for coord in self.uncarried_requested_shelf_coordinates])
+        self.dist_empty_agents_uncarried_requested_shelves = self._pairwise_dist(
+            np.array(self.uncarried_requested_shelf_coordinates),
+            np.array([[agent.y, agent.x] for agent in self.empty_agents]),
+        )
+
+        self.dist_goals_uncarried_requested_shelves = self._pairwise_dist(
+            np.array(self.uncarried_requested_shelf_coordinates), np.asarray(goals)
+        ).min(axis=1)
 
         # print("dist of goal and uncarried requested shelves", self.dist_goals_uncarried_requested_shelves)
         # print(self.dist_empty_agents_uncarried_requested_shelves)
@@ -983,13 +1339,15 @@ class Warehouse(gym.Env):
             self.max_inactivity_steps
             and self._cur_inactive_steps >= self.max_inactivity_steps
         ) or (self.max_steps and self._cur_steps >= self.max_steps):
-            dones = self.n_agents * [True]
+            dones = self._dones_true
         else:
-            dones = self.n_agents * [False]
+            dones = self._dones_false
 
-        new_obs = tuple([self._make_obs(agent) for agent in self.agents])
+        new_obs = self._make_obs_all()
         info = {}
-        return new_obs, list(rewards), dones, info
+        # rewards is the reused buffer; like the observations, consumers
+        # that keep it across steps must copy it
+        return new_obs, rewards, dones, info
 
     def render(self, mode="human"):
         if not self.renderer:
@@ -1007,18 +1365,25 @@ class Warehouse(gym.Env):
 
 
 if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Run a random-policy benchmark of the warehouse env"
+    )
+    parser.add_argument("--steps", type=int, default=100000)
+    parser.add_argument("--render", action="store_true")
+    args = parser.parse_args()
+
     env = Warehouse(9, 8, 3, 10, 3, 1, 5, None, None, RewardType.GLOBAL)
     # env = Warehouse(1, 3, 3, 2, 3, 1, 5, None, None, RewardType.INDIVIDUAL)
     env.reset()
-    import time
-    from tqdm import tqdm
-
-    time.sleep(2)
-    # env.render()
-    # env.step(18 * [Action.LOAD] + 2 * [Action.NOOP])
 
-    for _ in tqdm(range(1000000)):
-        time.sleep(2)
-        env.render()
+    start = time.time()
+    for _ in range(args.steps):
+        if args.render:
+            env.render()
         actions = env.action_space.sample()
         env.step(actions)
+    elapsed = time.time() - start
+    print(f"{args.steps} steps in {elapsed:.2f}s ({args.steps / elapsed:.0f} steps/s)")
@@ -20,7 +20,6 @@ setup(
         "numpy",
         "gym>=0.15",
         "pyglet",
-        "networkx",
     ],
     extras_require={"test": ["pytest"]},
     include_package_data=True,